@@ -5,79 +5,244 @@
 # @Author  : wangchongshi
 # @Email   : wangchongshi.wcs@antgroup.com
 # @FileName: prompt_util.py
-from typing import List
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator, List
 
-from langchain.chains.summarize import load_summarize_chain
 from langchain_core.documents import Document
+from langchain_core.prompts import PromptTemplate
 
 from agentuniverse.agent.memory.enum import ChatMessageEnum
 from agentuniverse.agent.memory.message import Message
+from agentuniverse.base.util.logging.logging_util import LOGGER
 from agentuniverse.llm.llm import LLM
 from agentuniverse.llm.llm_manager import LLMManager
 from agentuniverse.prompt.prompt_manager import PromptManager
 from agentuniverse.prompt.prompt_model import AgentPromptModel
 from agentuniverse.prompt.enum import PromptProcessEnum
 
+# The token count cache, which is used to avoid tokenizing the same text repeatedly.
+# _TOKEN_COUNT_CACHE - Format: {(llm_class, model_name, text_digest): token_count}.
+_TOKEN_COUNT_CACHE: OrderedDict = OrderedDict()
+_TOKEN_COUNT_CACHE_MAXSIZE = 4096
+_TOKEN_COUNT_CACHE_LOCK = threading.Lock()
+# The backoff seconds before retrying the failed token count.
+_TOKEN_COUNT_RETRY_BACKOFF = 0.1
+# One UTF-8 character is encoded by 4 bytes at most, hence split over 4 byte level tokens at most.
+_MAX_TOKENS_PER_CHAR = 4
+# The truncation without token ids aims at the ratio of the token limit, within the number of token counts.
+_TRUNCATE_TARGET_RATIO = 0.95
+_TRUNCATE_MAX_TOKEN_COUNTS = 4
+# The number of special tokens (e.g. BOS) a tokenizer may add besides the tokens of the text.
+_SPECIAL_TOKENS_MARGIN = 8
+
+
+def _count_tokens(llm: LLM, text: str) -> int:
+    """Get the number of tokens in the text, reusing the count of the same text measured before."""
+    return _count_tokens_batch(llm, [text])[0]
+
+
+def _count_tokens_batch(llm: LLM, texts: List[str], retry: bool = False) -> List[int]:
+    """Get the number of tokens in each text, the texts missing in the cache are counted by one batch call.
+
+    The tokenizer is determined by the llm class and its model name, so the cache is keyed by them
+    together with the content digest, and a changed model name never reuses stale counts.
+    With `retry`, the batch call is tried once more after a short backoff to ride out transient failures
+    of the remote tokenizers.
+    """
+    keys = [(type(llm), llm.model_name,
+             hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()) for text in texts]
+    token_counts = {}
+    with _TOKEN_COUNT_CACHE_LOCK:
+        for key in keys:
+            if key in _TOKEN_COUNT_CACHE:
+                _TOKEN_COUNT_CACHE.move_to_end(key)
+                token_counts[key] = _TOKEN_COUNT_CACHE[key]
+    missing_texts = {key: text for key, text in zip(keys, texts) if key not in token_counts}
+    if missing_texts:
+        for attempt in range(2 if retry else 1):
+            try:
+                token_count_list = llm.get_num_tokens_batch(list(missing_texts.values()))
+                break
+            except Exception as e:
+                if not retry or attempt > 0:
+                    raise e
+                LOGGER.warn(f'Failed to count tokens by llm {llm.name}, retrying, exception={e}')
+                time.sleep(_TOKEN_COUNT_RETRY_BACKOFF)
+        for key, num_tokens in zip(missing_texts.keys(), token_count_list):
+            token_counts[key] = num_tokens
+        with _TOKEN_COUNT_CACHE_LOCK:
+            for key in missing_texts.keys():
+                _TOKEN_COUNT_CACHE[key] = token_counts[key]
+            while len(_TOKEN_COUNT_CACHE) > _TOKEN_COUNT_CACHE_MAXSIZE:
+                _TOKEN_COUNT_CACHE.popitem(last=False)
+    return [token_counts[key] for key in keys]
+
 
 def summarize_by_stuff(texts: List[str], llm: LLM, summary_prompt):
     """
     stuff summarization -- general method
     """
-    stuff_chain = load_summarize_chain(llm.as_langchain(), chain_type='stuff', verbose=True,
-                                       prompt=summary_prompt.as_langchain())
-    return stuff_chain.run([Document(page_content=text) for text in texts])
+    return _load_stuff_chain(llm, summary_prompt).run([Document(page_content=text) for text in texts])
 
 
 def summarize_by_map_reduce(texts: List[str], llm: LLM, summary_prompt, combine_prompt):
     """
     map reduce summarization -- general method
     """
-    map_reduce_chain = load_summarize_chain(llm.as_langchain(), chain_type='map_reduce', verbose=True,
-                                            map_prompt=summary_prompt.as_langchain(),
-                                            combine_prompt=combine_prompt.as_langchain())
-    return map_reduce_chain.run([Document(page_content=text) for text in texts])
+    map_chain, reduce_chain = _load_map_reduce_chains(llm, summary_prompt, combine_prompt)
+    # the chunks are summarized independently, batch runs the llm calls concurrently.
+    summaries = [result[map_chain.output_key] for result in map_chain.batch([{'text': text} for text in texts])]
+    return reduce_chain.run([Document(page_content=summary) for summary in summaries])
+
+
+async def async_summarize_by_stuff(texts: List[str], llm: LLM, summary_prompt):
+    """
+    stuff summarization -- general async method
+    """
+    return await _load_stuff_chain(llm, summary_prompt).arun([Document(page_content=text) for text in texts])
+
+
+async def async_summarize_by_map_reduce(texts: List[str], llm: LLM, summary_prompt, combine_prompt):
+    """
+    map reduce summarization -- general async method
+    """
+    map_chain, reduce_chain = _load_map_reduce_chains(llm, summary_prompt, combine_prompt)
+    summaries = [result[map_chain.output_key] for result in await map_chain.abatch([{'text': text} for text in texts])]
+    return await reduce_chain.arun([Document(page_content=summary) for summary in summaries])
+
+
+def _load_stuff_chain(llm: LLM, summary_prompt):
+    """Build the langchain chain summarizing all texts in one llm call."""
+    # import the summarize chain lazily, it pulls in the whole langchain chains package.
+    from langchain.chains.summarize import load_summarize_chain
+    return load_summarize_chain(llm.as_langchain(), chain_type='stuff', verbose=True,
+                                prompt=summary_prompt.as_langchain())
+
+
+def _load_map_reduce_chains(llm: LLM, summary_prompt, combine_prompt):
+    """Build the map chain summarizing each text and the reduce chain combining the map results.
+
+    The reduce chain collapses the map results by the combine prompt until they fit in `token_max` tokens
+    before combining them, as the langchain map reduce summarize chain does.
+    """
+    # import the chains lazily, they pull in the whole langchain chains package.
+    from langchain.chains import LLMChain, ReduceDocumentsChain, StuffDocumentsChain
+    lc_llm = llm.as_langchain()
+    map_chain = LLMChain(llm=lc_llm, prompt=summary_prompt.as_langchain(), verbose=True)
+    combine_chain = StuffDocumentsChain(
+        llm_chain=LLMChain(llm=lc_llm, prompt=combine_prompt.as_langchain(), verbose=True),
+        document_variable_name='text', verbose=True)
+    reduce_chain = ReduceDocumentsChain(combine_documents_chain=combine_chain, token_max=3000, verbose=True)
+    return map_chain, reduce_chain
 
 
 def split_text_on_tokens(text: str, text_token: int, chunk_size=800, chunk_overlap=100) -> List[str]:
     """Split incoming text and return chunks using tokenizer."""
+    return list(_iter_char_chunks(text=text, text_token=text_token, chunk_size=chunk_size,
+                                  chunk_overlap=chunk_overlap))
+
+
+def split_text_on_token_ids(text: str, llm: LLM, chunk_size=800, chunk_overlap=100) -> List[str]:
+    """Split incoming text and return chunks using the token ids of the llm tokenizer."""
+    return list(_iter_chunks(text=text, llm=llm, chunk_size=chunk_size, chunk_overlap=chunk_overlap))
+
+
+def _iter_chunks(text: str, llm: LLM, chunk_size=800, chunk_overlap=100) -> Iterator[str]:
+    """Split incoming text and yield the chunks one by one using tokenizer.
+
+    The text is encoded once and the token ids are sliced by a sliding window with the stride of
+    `chunk_size - chunk_overlap`, so that each chunk holds `chunk_size` tokens at most. The llm without
+    a local tokenizer falls back to slicing the characters by the average number of characters per token.
+    """
+    if chunk_size <= chunk_overlap:
+        raise ValueError(f"chunk size {chunk_size} must be greater than the chunk overlap {chunk_overlap}.")
+    if not llm.support_token_ids():
+        yield from _iter_char_chunks(text=text, text_token=_count_tokens(llm, text), chunk_size=chunk_size,
+                                     chunk_overlap=chunk_overlap)
+        return
+
+    token_ids = llm.encode(text)
+    if len(token_ids) <= chunk_overlap:
+        yield text
+        return
+
+    start = 0
+    while True:
+        end = min(start + chunk_size, len(token_ids))
+        # the window keeps at least one token if its end can not be moved to a character boundary.
+        end = max(_snap_token_boundary(llm, token_ids, end), start + 1)
+        yield llm.decode(token_ids[start:end])
+        if end >= len(token_ids):
+            return
+        next_start = _snap_token_boundary(llm, token_ids, end - chunk_overlap)
+        start = next_start if next_start > start else end
+
+
+def _snap_token_boundary(llm: LLM, token_ids: list, position: int) -> int:
+    """Move the position back to the nearest token boundary not splitting a multibyte character.
+
+    Byte level tokenizers may split one character over several tokens, decoding a window cut in the middle
+    of the character gives the replacement character U+FFFD. The position is kept when no clean boundary is
+    found within the longest UTF-8 character.
+    """
+    if position <= 0 or position >= len(token_ids):
+        return position
+    for boundary in range(position, max(position - _MAX_TOKENS_PER_CHAR, -1), -1):
+        tail = llm.decode(token_ids[max(boundary - _MAX_TOKENS_PER_CHAR, 0):boundary])
+        if not tail.endswith('\ufffd'):
+            return boundary
+    return position
+
+
+def _decode_prefix(llm: LLM, token_ids: list, token_length: int) -> str:
+    """Decode the first `token_length` token ids at most, without splitting a multibyte character."""
+    return llm.decode(token_ids[:_snap_token_boundary(llm, token_ids, token_length)])
+
+
+def _iter_char_chunks(text: str, text_token: int, chunk_size=800, chunk_overlap=100) -> Iterator[str]:
+    """Split incoming text and yield the chunks by the number of characters represented by each token."""
+    if text_token <= 0:
+        yield text
+        return
+
     # calculate the number of characters represented by each token.
     char_per_token = len(text) / text_token
     chunk_char_size = int(chunk_size * char_per_token)
     chunk_char_overlap = int(chunk_overlap * char_per_token)
 
-    result = []
-    current_position = 0
-
-    while current_position + chunk_char_overlap < len(text):
-        if current_position + chunk_char_size >= len(text):
-            chunk = text[current_position:]
-        else:
-            chunk = text[current_position:current_position + chunk_char_size]
-
-        result.append(chunk)
-        current_position += chunk_char_size - chunk_char_overlap
-
-    if len(result) == 0:
-        result.append(text[current_position:])
+    if len(text) <= chunk_char_overlap:
+        yield text
+        return
 
-    return result
+    # the stride is kept positive as the character sizes are rounded down.
+    step = max(chunk_char_size - chunk_char_overlap, 1)
+    yield from (text[start:start + chunk_char_size] for start in range(0, len(text) - chunk_char_overlap, step))
 
 
 def split_texts(texts: list[str], llm: LLM, chunk_size=800, chunk_overlap=100, retry=True) -> list[str]:
     """
     split texts into chunks with the fixed token length -- general method
+
+    With `retry`, a failed token count of the remote tokenizer is retried once, the splitting itself is
+    deterministic and never redone.
     """
     try:
         split_texts_res = []
-        for text in texts:
-            text_token = llm.get_num_tokens(text)
+        if llm.support_token_ids():
+            for text in texts:
+                split_texts_res.extend(
+                    _iter_chunks(text=text, llm=llm, chunk_size=chunk_size, chunk_overlap=chunk_overlap))
+            return split_texts_res
+        # count the tokens of all texts at once when the llm has no local tokenizer.
+        for text, text_token in zip(texts, _count_tokens_batch(llm, texts, retry=retry)):
             split_texts_res.extend(
-                split_text_on_tokens(text=text, text_token=text_token, chunk_size=chunk_size,
-                                     chunk_overlap=chunk_overlap))
+                _iter_char_chunks(text=text, text_token=text_token, chunk_size=chunk_size,
+                                  chunk_overlap=chunk_overlap))
         return split_texts_res
     except Exception as e:
-        if retry:
-            return split_texts(texts=texts, llm=llm, retry=False)
         raise ValueError("split text failed, exception=" + str(e))
 
 
@@ -85,7 +250,41 @@ def truncate_content(content: str, token_length: int, llm: LLM) -> str:
     """
     truncate the content based on the llm token limit
     """
-    return str(split_texts(texts=[content], chunk_size=token_length, llm=llm)[0])
+    if token_length <= 0:
+        return ''
+    if llm.support_token_ids():
+        return _decode_prefix(llm, llm.encode(content), token_length)
+
+    content_token = _count_tokens(llm, content)
+    if content_token <= token_length:
+        return content
+    # estimate the prefix length by the characters per token and refine it with a few token counts, as the
+    # tokenizer may be remote. `low` is the longest prefix measured within the limit, `high` the shortest beyond.
+    target_token = token_length * _TRUNCATE_TARGET_RATIO
+    low, high = 0, len(content)
+    prefix_length, prefix_token = len(content), content_token
+    for _ in range(_TRUNCATE_MAX_TOKEN_COUNTS):
+        mid = int(prefix_length * target_token / max(prefix_token, 1))
+        if not low < mid < high:
+            mid = (low + high + 1) // 2
+        if mid >= high:
+            break
+        prefix_length, prefix_token = mid, llm.get_num_tokens(content[:mid])
+        if prefix_token > token_length:
+            high = mid
+            continue
+        low = mid
+        if prefix_token >= target_token:
+            break
+    # the estimates shrink from above and may all overshoot, e.g. when dense text comes before sparse text,
+    # so the prefix is bisected further until one fits.
+    while low == 0 and high > 1:
+        mid = high // 2
+        if llm.get_num_tokens(content[:mid]) <= token_length:
+            low = mid
+        else:
+            high = mid
+    return content[:low]
 
 
 def generate_template(agent_prompt_model: AgentPromptModel, prompt_assemble_order: list[str]) -> str:
@@ -130,6 +329,18 @@ def generate_chat_template(agent_prompt_model: AgentPromptModel, prompt_assemble
     return message_list
 
 
+def _format_prompt(lc_prompt_template, prompt_input_dict: dict) -> str:
+    """Format the langchain prompt template into the prompt string.
+
+    The plain f-string template is formatted by `str.format_map` directly, which gives the same result as the
+    pure python formatter used by langchain without parsing the template in python on every call.
+    """
+    if (isinstance(lc_prompt_template, PromptTemplate) and lc_prompt_template.template_format == 'f-string'
+            and not lc_prompt_template.partial_variables):
+        return lc_prompt_template.template.format_map(prompt_input_dict)
+    return lc_prompt_template.format(**prompt_input_dict)
+
+
 def process_llm_token(agent_llm: LLM, lc_prompt_template, profile: dict, planner_input: dict):
     """Process the prompt template based on the prompt processor.
 
@@ -139,6 +350,31 @@ def process_llm_token(agent_llm: LLM, lc_prompt_template, profile: dict, planner
         profile (dict): The profile.
         planner_input (dict): The planner input.
     """
+    input_tokens = agent_llm.max_context_length() - agent_llm.max_tokens
+    if input_tokens <= 0:
+        raise Exception("The current output max tokens limit is greater than the context length of the LLM model, "
+                        "please adjust it by editing the `max_tokens` parameter in the llm yaml.")
+
+    # compress the background in the prompt, nothing can be compressed without it.
+    content = planner_input.get('background')
+    if not content:
+        return
+
+    prompt_input_dict = {key: planner_input[key] for key in lc_prompt_template.input_variables if key in planner_input}
+    prompt = _format_prompt(lc_prompt_template, prompt_input_dict)
+    # the local byte level tokenizers never produce more tokens than the utf-8 bytes of the prompt besides a
+    # few special tokens, so the short prompt is known to fit without tokenizing it.
+    if agent_llm.support_token_ids() and \
+            len(prompt.encode('utf-8', 'surrogatepass')) + _SPECIAL_TOKENS_MARGIN <= input_tokens:
+        return
+
+    # get the number of tokens in the prompt
+    prompt_tokens: int = _count_tokens(agent_llm, prompt)
+
+    if prompt_tokens <= input_tokens:
+        return
+
+    # the prompt processor configuration is only resolved when the prompt exceeds the input tokens.
     llm_model: dict = profile.get('llm_model')
 
     # get the prompt processor configuration
@@ -150,42 +386,35 @@ def process_llm_token(agent_llm: LLM, lc_prompt_template, profile: dict, planner
     summary_prompt_version: str = prompt_processor.get('summary_prompt_version') or 'prompt_processor.summary_cn'
     combine_prompt_version: str = prompt_processor.get('combine_prompt_version') or 'prompt_processor.combine_cn'
 
-    prompt_input_dict = {key: planner_input[key] for key in lc_prompt_template.input_variables if key in planner_input}
-
-    # get the llm instance for prompt compression
-    prompt_llm: LLM = LLMManager().get_instance_obj(prompt_processor_llm)
-
-    if prompt_llm is None:
-        prompt_llm = agent_llm
-
-    prompt = lc_prompt_template.format(**prompt_input_dict)
-    # get the number of tokens in the prompt
-    prompt_tokens: int = agent_llm.get_num_tokens(prompt)
-
-    input_tokens = agent_llm.max_context_length() - agent_llm.max_tokens
-    if input_tokens <= 0:
-        raise Exception("The current output max tokens limit is greater than the context length of the LLM model, "
-                        "please adjust it by editing the `max_tokens` parameter in the llm yaml.")
-
-    if prompt_tokens <= input_tokens:
-        return
-
     process_prompt_type_enum = PromptProcessEnum.from_value(prompt_processor_type)
 
-    # compress the background in the prompt
-    content = planner_input.get('background')
+    if process_prompt_type_enum == PromptProcessEnum.TRUNCATE:
+        # truncate the background to the tokens left by the rest of the prompt, the token ids of the background
+        # are encoded once and reused for both counting and truncating.
+        if not agent_llm.support_token_ids():
+            remaining_tokens = input_tokens - (prompt_tokens - _count_tokens(agent_llm, content))
+            if remaining_tokens <= 0:
+                # the rest of the prompt leaves no room for the background.
+                planner_input['background'] = ''
+                return
+            planner_input['background'] = truncate_content(content, remaining_tokens, agent_llm)
+            return
+        content_token_ids = agent_llm.encode(content)
+        remaining_tokens = input_tokens - (prompt_tokens - len(content_token_ids))
+        planner_input['background'] = _decode_prefix(agent_llm, content_token_ids, max(remaining_tokens, 0))
+        return
 
-    if content:
-        if process_prompt_type_enum == PromptProcessEnum.TRUNCATE:
-            planner_input['background'] = truncate_content(content, input_tokens, agent_llm)
-        elif process_prompt_type_enum == PromptProcessEnum.STUFF:
-            planner_input['background'] = summarize_by_stuff(texts=[content], llm=prompt_llm,
-                                                             summary_prompt=PromptManager().get_instance_obj(
-                                                                 summary_prompt_version))
-        elif process_prompt_type_enum == PromptProcessEnum.MAP_REDUCE:
-            planner_input['background'] = summarize_by_map_reduce(texts=split_texts([content], agent_llm),
-                                                                  llm=prompt_llm,
-                                                                  summary_prompt=PromptManager().get_instance_obj(
-                                                                      summary_prompt_version),
-                                                                  combine_prompt=PromptManager().get_instance_obj(
-                                                                      combine_prompt_version))
+    # get the llm instance for prompt compression, the managers are only looked up by the summarization.
+    prompt_llm: LLM = agent_llm
+    if prompt_processor_llm:
+        prompt_llm = LLMManager().get_instance_obj(prompt_processor_llm) or agent_llm
+    prompt_manager = PromptManager()
+
+    if process_prompt_type_enum == PromptProcessEnum.STUFF:
+        planner_input['background'] = summarize_by_stuff(
+            texts=[content], llm=prompt_llm, summary_prompt=prompt_manager.get_instance_obj(summary_prompt_version))
+    elif process_prompt_type_enum == PromptProcessEnum.MAP_REDUCE:
+        planner_input['background'] = summarize_by_map_reduce(
+            texts=split_texts([content], agent_llm), llm=prompt_llm,
+            summary_prompt=prompt_manager.get_instance_obj(summary_prompt_version),
+            combine_prompt=prompt_manager.get_instance_obj(combine_prompt_version))
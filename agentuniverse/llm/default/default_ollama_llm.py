@@ -1,7 +1,6 @@
 import json
 from typing import Any, Union, AsyncIterator, Iterator, Optional, List, Sequence
 
-import tiktoken
 from langchain_core.language_models import BaseLanguageModel
 from ollama import Options
 from pydantic import Field
@@ -9,12 +8,12 @@ from pydantic import Field
 from agentuniverse.base.annotation.trace import trace_llm
 from agentuniverse.base.config.component_configer.configers.llm_configer import LLMConfiger
 from agentuniverse.base.util.env_util import get_from_env
-from agentuniverse.llm.llm import LLM
+from agentuniverse.llm.llm import LLM, TiktokenTokenizerMixin
 from agentuniverse.llm.llm_output import LLMOutput
 from agentuniverse.llm.ollama_langchain_instance import OllamaLangchainInstance
 
 
-class OllamaLLM(LLM):
+class OllamaLLM(TiktokenTokenizerMixin, LLM):
     base_url: Optional[str] = Field(
         default_factory=lambda: get_from_env("OLLAMA_BASE_URL") if get_from_env(
             "OLLAMA_BASE_URL") else "http://localhost:11434")
@@ -89,10 +88,3 @@ class OllamaLLM(LLM):
         if 'max_context_length' in component_configer.configer.value:
             self._max_context_length = component_configer.configer.value['max_context_length']
         return self
-
-    def get_num_tokens(self, text: str) -> int:
-        try:
-            encoding = tiktoken.encoding_for_model(self.model_name)
-        except KeyError:
-            encoding = tiktoken.get_encoding("cl100k_base")
-        return len(encoding.encode(text))
@@ -67,3 +67,6 @@ class KIMIOpenAIStyleLLM(OpenAIStyleLLM):
         headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {self.api_key}'}
         res = requests.post(f"{self.api_base}/tokenizers/estimate-token-count", headers=headers, json=body)
         return res.json().get('data').get('total_tokens')
+
+    def get_num_tokens_batch(self, texts: list[str]) -> list[int]:
+        return self._get_num_tokens_concurrently(texts)
@@ -5,9 +5,11 @@
 # @Author  : weizjajj
 # @Email   : weizhongjie.wzj@antgroup.com
 # @FileName: qwen_openai_style_llm.py
+from functools import lru_cache
 from typing import Optional, Any, Union, Iterator, AsyncIterator
 
 from dashscope import get_tokenizer
+from dashscope.tokenizers import Tokenizer
 from pydantic import Field
 
 from agentuniverse.base.annotation.trace import trace_llm
@@ -26,6 +28,12 @@ QWen_Max_CONTEXT_LENGTH = {
 }
 
 
+@lru_cache(maxsize=None)
+def _get_qwen_tokenizer(model_name: str) -> Tokenizer:
+    """Get the qwen tokenizer, dashscope loads the bpe file again on every `get_tokenizer` call."""
+    return get_tokenizer(model_name)
+
+
 class QWenOpenAIStyleLLM(OpenAIStyleLLM):
     """
         QWen OpenAI style LLM
@@ -67,5 +75,13 @@ class QWenOpenAIStyleLLM(OpenAIStyleLLM):
         return QWen_Max_CONTEXT_LENGTH.get(self.model_name, 8000)
 
     def get_num_tokens(self, text: str) -> int:
-        tokenizer = get_tokenizer(self.model_name)
-        return len(tokenizer.encode(text))
+        return len(self.encode(text))
+
+    def support_token_ids(self) -> bool:
+        return True
+
+    def encode(self, text: str) -> list[int]:
+        return _get_qwen_tokenizer(self.model_name).encode(text)
+
+    def decode(self, token_ids: list[int]) -> str:
+        return _get_qwen_tokenizer(self.model_name).decode(token_ids)
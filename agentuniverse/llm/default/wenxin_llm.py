@@ -115,6 +115,9 @@ class WenXinLLM(LLM):
         )
         return token_cnt
 
+    def get_num_tokens_batch(self, texts: list[str]) -> list[int]:
+        return self._get_num_tokens_concurrently(texts)
+
     @staticmethod
     def parse_result(chunk: QfResponse):
         text = chunk.body.get('result')
@@ -7,7 +7,11 @@ import queue
 # @FileName: llm.py
 
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Optional, Any, AsyncIterator, Iterator, Union
+
+import tiktoken
 from langchain_core.language_models.base import BaseLanguageModel
 from langchain_core.runnables import Runnable
 
@@ -20,6 +24,55 @@ from agentuniverse.base.util.logging.logging_util import LOGGER
 from agentuniverse.llm.llm_output import LLMOutput
 
 
+@lru_cache(maxsize=None)
+def get_tiktoken_encoding(model_name: Optional[str]) -> tiktoken.Encoding:
+    """Get the tiktoken encoding of the model, fall back to cl100k_base for the unknown models.
+
+    The encoding is resolved once per model name, avoiding the model lookup (and the KeyError raised for the
+    non-openai model names) on every token count.
+    """
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class TiktokenTokenizerMixin:
+    """Count tokens and expose the token ids by the tiktoken encoding of the model.
+
+    Mixed in before `LLM` by the llms tokenizing with tiktoken. A subclass overriding `get_num_tokens` counts with
+    its own tokenizer, so its batch count falls back to `get_num_tokens` and the tiktoken token ids are not exposed.
+    """
+
+    def _count_by_tiktoken(self) -> bool:
+        return type(self).get_num_tokens is TiktokenTokenizerMixin.get_num_tokens
+
+    def get_num_tokens(self, text: str) -> int:
+        """Get the number of tokens present in the text by the tiktoken encoding of the model."""
+        return len(self.encode(text))
+
+    def get_num_tokens_batch(self, texts: list[str]) -> list[int]:
+        """Get the number of tokens present in each of the texts by the tiktoken batch encoding."""
+        if not self._count_by_tiktoken():
+            return super().get_num_tokens_batch(texts)
+        return [len(token_ids) for token_ids in get_tiktoken_encoding(self.model_name).encode_batch(texts)]
+
+    def support_token_ids(self) -> bool:
+        return self._count_by_tiktoken()
+
+    def encode(self, text: str) -> list[int]:
+        """Encode the text into token ids with the tiktoken encoding of the model."""
+        if not self._count_by_tiktoken():
+            return super().encode(text)
+        return get_tiktoken_encoding(self.model_name).encode(text)
+
+    def decode(self, token_ids: list[int]) -> str:
+        """Decode the token ids into text with the tiktoken encoding of the model."""
+        if not self._count_by_tiktoken():
+            return super().decode(token_ids)
+        return get_tiktoken_encoding(self.model_name).decode(token_ids)
+
+
 class LLM(ComponentBase):
     """The basic class for llm model.
 
@@ -156,6 +209,71 @@ class LLM(ComponentBase):
             The integer number of tokens in the text.
         """
 
+    def get_num_tokens_batch(self, texts: list[str]) -> list[int]:
+        """Get the number of tokens present in each of the texts.
+
+        Llms whose tokenizer supports batch encoding or a batch tokenize endpoint should override it, llms
+        tokenizing remotely one text per request may override it with `_get_num_tokens_concurrently`.
+
+        Args:
+            texts: The string inputs to tokenize.
+
+        Returns:
+            The integer number of tokens in each text.
+        """
+        return [self.get_num_tokens(text) for text in texts]
+
+    def _get_num_tokens_concurrently(self, texts: list[str]) -> list[int]:
+        """Get the number of tokens in each of the texts by concurrent `get_num_tokens` calls.
+
+        Only worth it for the remote tokenizer, which pays about one request latency instead of one per text,
+        the local tokenizer is CPU bound and gains nothing from threads.
+        """
+        if len(texts) <= 1:
+            return [self.get_num_tokens(text) for text in texts]
+        with ThreadPoolExecutor(max_workers=min(32, len(texts)), thread_name_prefix="llm_tokenizer") as executor:
+            return list(executor.map(self.get_num_tokens, texts))
+
+    def support_token_ids(self) -> bool:
+        """Whether the llm exposes the token ids of the tokenizer used by `get_num_tokens`.
+
+        Llms returning True must implement `encode` and `decode` with the same tokenizer as `get_num_tokens`, and
+        the tokenizer must be byte level: a text never encodes into more tokens than its UTF-8 bytes besides a few
+        special tokens, which lets `process_llm_token` skip counting the short prompts.
+        """
+        return False
+
+    def encode(self, text: str) -> list[int]:
+        """Encode the text into token ids with the tokenizer of the llm.
+
+        Only llms backed by a local tokenizer support it (see `support_token_ids`), the others only count tokens
+        by `get_num_tokens`.
+
+        Args:
+            text: The string input to tokenize.
+
+        Returns:
+            The token ids of the text.
+
+        Raises:
+            NotImplementedError: The llm does not expose its tokenizer.
+        """
+        raise NotImplementedError(f'{self.__class__.__name__} does not support encoding text into token ids.')
+
+    def decode(self, token_ids: list[int]) -> str:
+        """Decode the token ids into text with the tokenizer of the llm.
+
+        Args:
+            token_ids: The token ids to decode.
+
+        Returns:
+            The decoded text.
+
+        Raises:
+            NotImplementedError: The llm does not expose its tokenizer.
+        """
+        raise NotImplementedError(f'{self.__class__.__name__} does not support decoding token ids into text.')
+
     def as_langchain_runnable(self, params=None) -> Runnable:
         """Get the langchain llm class."""
         if params is None:
@@ -11,10 +11,9 @@ import httpx
 from langchain_core.language_models.base import BaseLanguageModel
 from openai import OpenAI, AsyncOpenAI
 from pydantic import Field
-import tiktoken
 
 from agentuniverse.llm.langchain_instance import LangchainOpenAI
-from agentuniverse.llm.llm import LLM, LLMOutput
+from agentuniverse.llm.llm import LLM, LLMOutput, TiktokenTokenizerMixin
 from agentuniverse.base.util.env_util import get_from_env
 
 OPENAI_MAX_CONTEXT_LENGTH = {
@@ -39,7 +38,7 @@ OPENAI_MAX_CONTEXT_LENGTH = {
 }
 
 
-class OpenAILLM(LLM):
+class OpenAILLM(TiktokenTokenizerMixin, LLM):
     """The openai llm class.
 
     Attributes:
@@ -153,23 +152,6 @@ class OpenAILLM(LLM):
           """
         return OPENAI_MAX_CONTEXT_LENGTH.get(self.model_name, 4096)
 
-    def get_num_tokens(self, text: str) -> int:
-        """Get the number of tokens present in the text.
-
-        Useful for checking if an input will fit in an openai model's context window.
-
-        Args:
-            text: The string input to tokenize.
-
-        Returns:
-            The integer number of tokens in the text.
-        """
-        try:
-            encoding = tiktoken.encoding_for_model(self.model_name)
-        except KeyError:
-            encoding = tiktoken.get_encoding("cl100k_base")
-        return len(encoding.encode(text))
-
     @staticmethod
     def parse_result(chunk):
         """Generate the result of the stream."""
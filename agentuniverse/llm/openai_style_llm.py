@@ -10,17 +10,16 @@ from typing import Any, Optional, AsyncIterator, Iterator, Union
 
 import httpx
 import openai
-import tiktoken
 from langchain_core.language_models.base import BaseLanguageModel
 from openai import OpenAI, AsyncOpenAI
 
 from agentuniverse.base.config.component_configer.configers.llm_configer import LLMConfiger
 from agentuniverse.base.util.env_util import get_from_env
-from agentuniverse.llm.llm import LLM, LLMOutput
+from agentuniverse.llm.llm import LLM, LLMOutput, TiktokenTokenizerMixin
 from agentuniverse.llm.openai_style_langchain_instance import LangchainOpenAIStyleInstance
 
 
-class OpenAIStyleLLM(LLM):
+class OpenAIStyleLLM(TiktokenTokenizerMixin, LLM):
     """This is a wrapper around the OpenAI API that implements a chat interface for the LLM.
 
     It uses the `chat` endpoint of the OpenAI API.
@@ -175,23 +174,6 @@ class OpenAIStyleLLM(LLM):
             self.api_key = get_from_env(component_configer.configer.value.get('api_key_env'))
         return super().initialize_by_component_configer(component_configer)
 
-    def get_num_tokens(self, text: str) -> int:
-        """Get the number of tokens present in the text.
-
-        Useful for checking if an input will fit in an openai model's context window.
-
-        Args:
-            text: The string input to tokenize.
-
-        Returns:
-            The integer number of tokens in the text.
-        """
-        try:
-            encoding = tiktoken.encoding_for_model(self.model_name)
-        except KeyError:
-            encoding = tiktoken.get_encoding("cl100k_base")
-        return len(encoding.encode(text))
-
     def max_context_length(self) -> int:
         """Return the maximum length of the context."""
         if super().max_context_length():
@@ -0,0 +1,425 @@
+# !/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# @Time    : 2026/10/15 07:08
+# @Author  : agent
+# @Email   : agent@local
+# @FileName: test_prompt_util.py
+
+import asyncio
+from typing import ClassVar
+
+import pytest
+from langchain_core.language_models.chat_models import SimpleChatModel
+from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+
+from agentuniverse.base.util import prompt_util
+from agentuniverse.base.util.prompt_util import split_text_on_token_ids, split_text_on_tokens, split_texts, \
+    truncate_content
+from agentuniverse.llm.default.qwen_openai_style_llm import QWenOpenAIStyleLLM
+from agentuniverse.llm.llm import LLM
+from agentuniverse.prompt.prompt import Prompt
+
+
+class WordLLM(LLM):
+    """Fake llm counting one token per word, without token ids."""
+
+    calls: int = 0
+    failures: int = 0
+
+    def _call(self, *args, **kwargs):
+        pass
+
+    async def _acall(self, *args, **kwargs):
+        pass
+
+    def get_num_tokens(self, text: str) -> int:
+        self.calls += 1
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError('tokenizer unavailable')
+        return len(text.split())
+
+
+class BatchWordLLM(WordLLM):
+    """Fake llm recording the batch token counts."""
+
+    batches: list = []
+
+    def get_num_tokens_batch(self, texts: list) -> list:
+        self.batches.append(list(texts))
+        return super().get_num_tokens_batch(texts)
+
+
+class WordIdLLM(WordLLM):
+    """Fake llm exposing the words as token ids, recording the decoded windows."""
+
+    decoded: int = 0
+
+    def support_token_ids(self) -> bool:
+        return True
+
+    def encode(self, text: str) -> list:
+        return text.split(' ')
+
+    def decode(self, token_ids: list) -> str:
+        self.decoded += 1
+        return ' '.join(token_ids)
+
+    def get_num_tokens(self, text: str) -> int:
+        self.calls += 1
+        return len(self.encode(text))
+
+
+class CjkLLM(WordLLM):
+    """Fake llm counting one token per CJK character and one token per 4 other characters."""
+
+    def get_num_tokens(self, text: str) -> int:
+        self.calls += 1
+        cjk_chars = sum(1 for char in text if ord(char) > 127)
+        return cjk_chars + (len(text) - cjk_chars) // 4
+
+
+class ByteIdLLM(WordLLM):
+    """Fake byte level llm, which splits a multibyte character over several token ids."""
+
+    def support_token_ids(self) -> bool:
+        return True
+
+    def encode(self, text: str) -> list:
+        return list(text.encode('utf-8'))
+
+    def decode(self, token_ids: list) -> str:
+        return bytes(token_ids).decode('utf-8', 'replace')
+
+    def get_num_tokens(self, text: str) -> int:
+        self.calls += 1
+        return len(self.encode(text))
+
+
+class EchoChatModel(SimpleChatModel):
+    """Fake langchain chat model answering with the bracketed prompt, or with `answer` when given."""
+
+    answer: str = ''
+    prompts: ClassVar[list] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return 'echo'
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text.split())
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs) -> str:
+        self.prompts.append(messages[-1].content)
+        return self.answer or f'[{messages[-1].content}]'
+
+
+class EchoLLM(WordLLM):
+    """Fake llm backed by the echo chat model."""
+
+    answer: str = ''
+
+    def as_langchain(self):
+        return EchoChatModel(answer=self.answer)
+
+
+SUMMARY_PROMPT = Prompt(prompt_template='sum {text}', input_variables=['text'])
+COMBINE_PROMPT = Prompt(prompt_template='comb {text}', input_variables=['text'])
+PLANNER_PROMPT = PromptTemplate(template='intro {input}\nbg: {background}', input_variables=['input', 'background'])
+
+
+def build_llm(llm_cls, max_context_length: int, max_tokens: int = 10) -> LLM:
+    llm = llm_cls(model_name=llm_cls.__name__, max_tokens=max_tokens)
+    llm._max_context_length = max_context_length
+    return llm
+
+
+@pytest.fixture(autouse=True)
+def clear_token_count_cache(monkeypatch):
+    prompt_util._TOKEN_COUNT_CACHE.clear()
+    monkeypatch.setattr(prompt_util, '_TOKEN_COUNT_RETRY_BACKOFF', 0)
+    yield
+    prompt_util._TOKEN_COUNT_CACHE.clear()
+
+
+def test_count_tokens_cache():
+    llm = WordLLM(model_name='word')
+    assert prompt_util._count_tokens(llm, 'a b c') == 3
+    assert prompt_util._count_tokens(llm, 'a b c') == 3
+    assert llm.calls == 1
+
+    # the same text of another model is counted again.
+    other_llm = WordLLM(model_name='other_word')
+    assert prompt_util._count_tokens(other_llm, 'a b c') == 3
+    assert other_llm.calls == 1
+
+
+def test_count_tokens_cache_eviction(monkeypatch):
+    monkeypatch.setattr(prompt_util, '_TOKEN_COUNT_CACHE_MAXSIZE', 2)
+    llm = WordLLM(model_name='word')
+    for text in ('a', 'a b', 'a'):
+        prompt_util._count_tokens(llm, text)
+    # 'a' is the most recently used, so 'a b' is evicted by the new text.
+    prompt_util._count_tokens(llm, 'a b c')
+    assert len(prompt_util._TOKEN_COUNT_CACHE) == 2
+    assert llm.calls == 3
+    prompt_util._count_tokens(llm, 'a')
+    assert llm.calls == 3
+    prompt_util._count_tokens(llm, 'a b')
+    assert llm.calls == 4
+
+
+def test_count_tokens_batch_cache():
+    llm = BatchWordLLM(model_name='word')
+    assert prompt_util._count_tokens_batch(llm, ['a', 'a b', 'a']) == [1, 2, 1]
+    assert prompt_util._count_tokens_batch(llm, ['a b', 'a b c']) == [2, 3]
+    # the duplicated and cached texts are not counted again.
+    assert llm.batches == [['a', 'a b'], ['a b c']]
+
+
+def test_split_texts_batch_count():
+    llm = BatchWordLLM(model_name='word')
+    texts = ['abcd ' * 100, 'ab ' * 30]
+    assert split_texts(texts, llm, chunk_size=30, chunk_overlap=10) == \
+           split_text_on_tokens(texts[0], 100, chunk_size=30, chunk_overlap=10) + [texts[1]]
+    assert llm.batches == [texts]
+
+
+def test_split_text_on_token_ids_multibyte():
+    llm = ByteIdLLM(model_name='byte')
+    text = '智能体框架ab😀' * 30
+    chunks = split_text_on_token_ids(text, llm, chunk_size=20, chunk_overlap=5)
+    assert all('\ufffd' not in chunk for chunk in chunks)
+    assert all(len(chunk.encode('utf-8')) <= 20 for chunk in chunks)
+    assert all(chunk in text for chunk in chunks)
+    assert text.startswith(chunks[0]) and text.endswith(chunks[-1])
+
+
+def test_split_text_on_token_ids_qwen():
+    llm = QWenOpenAIStyleLLM(model_name='qwen-turbo')
+    # the rare characters and emoji are split over several tokens by the qwen tokenizer.
+    text = '智能体㐀㐁㐂𠀀𠀁𠀂😀🎉🧩🦄' * 40
+    chunks = split_text_on_token_ids(text, llm, chunk_size=11, chunk_overlap=3)
+    assert all('\ufffd' not in chunk for chunk in chunks)
+    assert all(llm.get_num_tokens(chunk) <= 11 for chunk in chunks)
+    assert text.startswith(chunks[0]) and text.endswith(chunks[-1])
+
+
+def test_split_texts_token_ids():
+    llm = ByteIdLLM(model_name='byte')
+    assert split_texts(['abcdefghij' * 3], llm, chunk_size=20, chunk_overlap=5) == \
+           ['abcdefghij' * 2, 'fghij' + 'abcdefghij']
+
+
+def test_split_text_on_tokens():
+    # 1000 characters of 100 tokens, 10 characters per token.
+    chunks = split_text_on_tokens('a' * 1000, 100, chunk_size=30, chunk_overlap=10)
+    assert [len(chunk) for chunk in chunks] == [300, 300, 300, 300, 200]
+    assert split_text_on_tokens('abc', 1, chunk_size=30, chunk_overlap=10) == ['abc']
+
+
+def test_truncate_content_token_ids():
+    llm = ByteIdLLM(model_name='byte')
+    assert truncate_content('智能😀体', 10, llm) == '智能😀'
+    assert truncate_content('智能😀体', 9, llm) == '智能'
+    assert truncate_content('智能😀体', 2, llm) == ''
+
+
+def test_truncate_content_without_token_ids():
+    llm = WordLLM(model_name='word')
+    content = ' '.join(['word'] * 50 + ['a b c d e f g h'] * 50)
+    assert truncate_content(content, 1000, llm) == content
+
+    for token_length in (1, 37, 120, 449):
+        llm.calls = 0
+        prompt_util._TOKEN_COUNT_CACHE.clear()
+        truncated = truncate_content(content, token_length, llm)
+        assert content.startswith(truncated)
+        assert 0 < len(truncated.split()) <= token_length
+        # one count of the whole content and a few counts of the prefixes.
+        assert llm.calls <= 1 + prompt_util._TRUNCATE_MAX_TOKEN_COUNTS
+
+
+@pytest.mark.parametrize('token_length', [127, 141, 148, 169, 181])
+def test_truncate_content_dense_text_first(token_length):
+    # the estimates by the average characters per token all overshoot the limit on the dense prefix.
+    llm = CjkLLM(model_name='cjk')
+    content = '智能体' * 50 + ' agent' * 400
+    truncated = truncate_content(content, token_length, llm)
+    assert content.startswith(truncated)
+    assert token_length // 2 <= llm.get_num_tokens(truncated) <= token_length
+
+
+def test_summarize_by_stuff():
+    llm = EchoLLM(model_name='echo')
+    assert prompt_util.summarize_by_stuff(['a', 'b'], llm, SUMMARY_PROMPT) == '[sum a\n\nb]'
+    assert asyncio.run(prompt_util.async_summarize_by_stuff(['a', 'b'], llm, SUMMARY_PROMPT)) == '[sum a\n\nb]'
+
+
+def test_summarize_by_map_reduce():
+    llm = EchoLLM(model_name='echo')
+    expected = '[comb [sum a]\n\n[sum b]\n\n[sum c]]'
+    assert prompt_util.summarize_by_map_reduce(['a', 'b', 'c'], llm, SUMMARY_PROMPT, COMBINE_PROMPT) == expected
+    assert asyncio.run(prompt_util.async_summarize_by_map_reduce(
+        ['a', 'b', 'c'], llm, SUMMARY_PROMPT, COMBINE_PROMPT)) == expected
+
+
+def test_summarize_by_map_reduce_collapse():
+    # each summary of 1000 tokens, the 8 summaries are collapsed to fit in the token max of 3000.
+    llm = EchoLLM(model_name='echo', answer='w ' * 1000)
+    EchoChatModel.prompts.clear()
+    prompt_util.summarize_by_map_reduce(['a'] * 8, llm, SUMMARY_PROMPT, COMBINE_PROMPT)
+    combine_prompts = [prompt for prompt in EchoChatModel.prompts if prompt.startswith('comb')]
+    assert len(EchoChatModel.prompts) == 8 + len(combine_prompts)
+    assert len(combine_prompts) > 1
+    assert all(len(prompt.split()) <= 3000 for prompt in combine_prompts)
+
+
+def test_format_prompt():
+    prompt_input_dict = {'input': 'who {are} you', 'background': 'bg'}
+    lc_prompt_template = PromptTemplate(template='intro {input}\nbg: {background}',
+                                        input_variables=['input', 'background'])
+    assert prompt_util._format_prompt(lc_prompt_template, prompt_input_dict) == \
+           lc_prompt_template.format(**prompt_input_dict)
+
+    partial_template = PromptTemplate(template='{date} {input} {background}', input_variables=['input', 'background'],
+                                      partial_variables={'date': 'today'})
+    assert prompt_util._format_prompt(partial_template, prompt_input_dict) == 'today who {are} you bg'
+
+    chat_template = ChatPromptTemplate.from_messages([('system', 'intro {background}'), ('human', '{input}')])
+    assert prompt_util._format_prompt(chat_template, prompt_input_dict) == \
+           chat_template.format(**prompt_input_dict)
+
+
+@pytest.mark.parametrize('background', [None, ''])
+def test_process_llm_token_without_background(background):
+    llm = build_llm(WordLLM, 20)
+    planner_input = {'input': 'q', 'background': background}
+    # the profile is never read without the background.
+    prompt_util.process_llm_token(llm, PLANNER_PROMPT, {}, planner_input)
+    assert planner_input == {'input': 'q', 'background': background}
+    assert llm.calls == 0
+
+
+def test_process_llm_token_short_prompt():
+    # the prompt of 20 bytes fits in 100 input tokens of the byte level tokenizer without counting it.
+    llm = build_llm(ByteIdLLM, 110)
+    planner_input = {'input': 'q', 'background': 'short bg'}
+    prompt_util.process_llm_token(llm, PLANNER_PROMPT, {}, planner_input)
+    assert planner_input['background'] == 'short bg'
+    assert llm.calls == 0
+
+    # the prompt within the margin of special tokens is counted.
+    llm = build_llm(ByteIdLLM, 35)
+    prompt_util.process_llm_token(llm, PLANNER_PROMPT, {}, planner_input)
+    assert planner_input['background'] == 'short bg'
+    assert llm.calls == 1
+
+    # the llm without token ids is always counted.
+    llm = build_llm(WordLLM, 110)
+    prompt_util.process_llm_token(llm, PLANNER_PROMPT, {}, planner_input)
+    assert planner_input['background'] == 'short bg'
+    assert llm.calls == 1
+
+
+def test_split_texts_retry():
+    llm = WordLLM(model_name='word', failures=1)
+    assert split_texts(['a b c'], llm, chunk_size=10, chunk_overlap=2) == ['a b c']
+    assert llm.calls == 2
+
+
+def test_split_texts_retry_failed():
+    llm = WordLLM(model_name='word', failures=2)
+    with pytest.raises(ValueError, match='tokenizer unavailable'):
+        split_texts(['a b c'], llm, chunk_size=10, chunk_overlap=2)
+    assert llm.calls == 2
+
+    llm = WordLLM(model_name='word', failures=1)
+    with pytest.raises(ValueError):
+        split_texts(['a b c'], llm, chunk_size=10, chunk_overlap=2, retry=False)
+    assert llm.calls == 1
+
+
+def test_iter_chunks_lazily():
+    llm = WordIdLLM(model_name='word')
+    text = ' '.join(str(i) for i in range(1000))
+    chunks = prompt_util._iter_chunks(text, llm, chunk_size=10, chunk_overlap=3)
+    assert llm.decoded == 0
+    assert next(chunks) == ' '.join(str(i) for i in range(10))
+    # only the first window and its boundary checks are decoded.
+    assert llm.decoded <= 3
+
+    char_chunks = prompt_util._iter_char_chunks('a' * 1000, 100, chunk_size=30, chunk_overlap=10)
+    assert next(char_chunks) == 'a' * 300
+
+
+def test_split_text_on_token_ids_windows():
+    llm = WordIdLLM(model_name='word')
+    words = [str(i) for i in range(57)]
+    chunks = split_text_on_token_ids(' '.join(words), llm, chunk_size=10, chunk_overlap=3)
+    assert chunks == [' '.join(words[start:start + 10]) for start in range(0, 57 - 3, 7)]
+    assert split_text_on_token_ids('a b', llm, chunk_size=10, chunk_overlap=3) == ['a b']
+
+
+def test_split_text_on_tokens_windows():
+    # 997 characters of 123 tokens: windows of 243 characters with a stride of 187.
+    text = ''.join(chr(0x4e00 + i) for i in range(997))
+    chunks = split_text_on_tokens(text, 123, chunk_size=30, chunk_overlap=7)
+    assert chunks == [text[start:start + 243] for start in (0, 187, 374, 561, 748, 935)]
+
+
+@pytest.mark.parametrize('llm_cls', [WordLLM, WordIdLLM])
+def test_process_llm_token_truncate(llm_cls):
+    # 50 input tokens, the rest of the prompt 'intro q bg:' takes 3 words.
+    llm = build_llm(llm_cls, 60)
+    background = ' '.join(str(i) for i in range(200))
+    planner_input = {'input': 'q', 'background': background}
+    prompt_util.process_llm_token(llm, PLANNER_PROMPT, {'llm_model': {}}, planner_input)
+    assert background.startswith(planner_input['background'])
+    assert 0 < llm.get_num_tokens(PLANNER_PROMPT.format(**planner_input)) <= 50
+
+
+@pytest.mark.parametrize('llm_cls', [WordLLM, WordIdLLM])
+def test_process_llm_token_truncate_without_room(llm_cls):
+    # the input alone exceeds the 50 input tokens.
+    llm = build_llm(llm_cls, 60)
+    planner_input = {'input': ' '.join(['q'] * 60), 'background': 'a b c'}
+    prompt_util.process_llm_token(llm, PLANNER_PROMPT, {'llm_model': {}}, planner_input)
+    assert planner_input['background'] == ''
+    # the prompt and the background are counted once each, no prefix is counted.
+    assert llm.calls <= 2
+
+
+def test_truncate_content_without_room():
+    llm = WordLLM(model_name='word')
+    assert truncate_content('a b c', 0, llm) == ''
+    assert truncate_content('a b c', -5, llm) == ''
+    assert llm.calls == 0
+
+
+class RecordingDict(dict):
+    """Dict recording the looked up keys."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.looked_up = []
+
+    def get(self, key, default=None):
+        self.looked_up.append(key)
+        return super().get(key, default)
+
+
+def test_process_llm_token_processor_config_on_overflow():
+    llm = build_llm(WordLLM, 60)
+    profile = RecordingDict(llm_model=RecordingDict(prompt_processor={'type': 'truncate'}))
+    planner_input = {'input': 'q', 'background': 'a b c'}
+    prompt_util.process_llm_token(llm, PLANNER_PROMPT, profile, planner_input)
+    assert planner_input['background'] == 'a b c'
+    assert profile.looked_up == []
+
+    planner_input = {'input': 'q', 'background': ' '.join(['w'] * 100)}
+    prompt_util.process_llm_token(llm, PLANNER_PROMPT, profile, planner_input)
+    assert profile.looked_up == ['llm_model']
+    assert profile['llm_model'].looked_up == ['prompt_processor']
+    assert len(planner_input['background'].split()) < 100
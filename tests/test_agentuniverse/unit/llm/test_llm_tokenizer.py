@@ -0,0 +1,74 @@
+# !/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# @Time    : 2026/10/15 07:30
+# @Author  : agent
+# @Email   : agent@local
+# @FileName: test_llm_tokenizer.py
+
+import pytest
+
+from agentuniverse.llm.default.kimi_openai_style_llm import KIMIOpenAIStyleLLM
+from agentuniverse.llm.default.qwen_openai_style_llm import QWenOpenAIStyleLLM
+from agentuniverse.llm.openai_llm import OpenAILLM
+from agentuniverse.llm.openai_style_llm import OpenAIStyleLLM
+
+
+class WordOpenAILLM(OpenAILLM):
+    """Fake openai llm counting tokens with its own tokenizer."""
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text.split())
+
+
+class WordOpenAIStyleLLM(OpenAIStyleLLM):
+    """Fake openai style llm counting tokens with its own tokenizer."""
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text.split())
+
+
+@pytest.mark.parametrize('llm_cls', [WordOpenAILLM, WordOpenAIStyleLLM])
+def test_get_num_tokens_batch_subclass_tokenizer(llm_cls):
+    llm = llm_cls(model_name='gpt-4')
+    assert llm.get_num_tokens_batch(['a b c', 'a', '']) == [3, 1, 0]
+
+
+def test_ollama_get_num_tokens_batch_subclass_tokenizer():
+    pytest.importorskip('ollama')
+    from agentuniverse.llm.default.default_ollama_llm import OllamaLLM
+
+    class WordOllamaLLM(OllamaLLM):
+        def get_num_tokens(self, text: str) -> int:
+            return len(text.split())
+
+    assert WordOllamaLLM(model_name='llama3').get_num_tokens_batch(['a b c', 'a']) == [3, 1]
+
+
+@pytest.mark.parametrize('llm_cls', [WordOpenAILLM, WordOpenAIStyleLLM])
+def test_subclass_tokenizer_hides_tiktoken_token_ids(llm_cls):
+    llm = llm_cls(model_name='gpt-4')
+    assert not llm.support_token_ids()
+    with pytest.raises(NotImplementedError):
+        llm.encode('a b c')
+    with pytest.raises(NotImplementedError):
+        llm.decode([1, 2])
+
+
+@pytest.mark.parametrize('llm_cls', [OpenAILLM, OpenAIStyleLLM])
+def test_tiktoken_llm_supports_token_ids(llm_cls):
+    assert llm_cls(model_name='gpt-4').support_token_ids()
+
+
+def test_kimi_token_ids_not_supported():
+    assert not KIMIOpenAIStyleLLM(model_name='moonshot-v1-8k').support_token_ids()
+
+
+def test_qwen_token_ids():
+    llm = QWenOpenAIStyleLLM(model_name='qwen-turbo')
+    text = '智能体框架 agentUniverse'
+    token_ids = llm.encode(text)
+    assert llm.support_token_ids()
+    assert llm.decode(token_ids) == text
+    assert llm.get_num_tokens(text) == len(token_ids)
+    assert llm.get_num_tokens_batch([text, 'a']) == [len(token_ids), 1]